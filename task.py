@@ -1,17 +1,28 @@
-import requests
-from requests.adapters import HTTPAdapter
+import urllib3
 from urllib3.util.retry import Retry
 import sqlite3
 import threading
+import queue
+import time
+import asyncio
+import aiohttp
 from tqdm import tqdm  # Progress bar library
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
-from shapely.geometry import shape, box  # Geometry handling library
-import math
+import hashlib
+import itertools
+import pathlib
+import os
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape  # Geometry handling library
+import numpy as np
+import zstandard
 
 # Configure logging for tile downloading activities and skipped tiles.
-logging.basicConfig(filename='tile_downloader.log', level=logging.INFO, format='%(asctime)s %(message)s')
+# The thread id comes from the record itself, so it is only looked up for records that are actually emitted.
+logging.basicConfig(filename='tile_downloader.log', level=logging.INFO, format='%(asctime)s Thread %(thread)d: %(message)s')
 
 # Setup for logging skipped tiles to avoid clutter in the main log.
 skipped_tiles_logger = logging.getLogger("skipped_tiles")
@@ -23,7 +34,7 @@ skipped_tiles_logger.propagate = False  # Prevent logs from being propagated to
 
 # Configuration class for storing downloader settings.
 class Config:
-    def __init__(self, url_template, zoom_levels, rate_limit, mbtiles_file, user_agent, max_threads):
+    def __init__(self, url_template, zoom_levels, rate_limit, mbtiles_file, user_agent, max_threads, concurrency=None):
         # URL template for tile requests, includes placeholders for zoom/x/y.
         self.url_template = url_template
         # Tuple defining the minimum and maximum zoom levels to download.
@@ -36,84 +47,258 @@ class Config:
         self.user_agent = user_agent
         # Maximum number of concurrent download threads.
         self.max_threads = max_threads
+        # Number of in-flight requests when downloading with asyncio; None uses the thread pool instead.
+        self.concurrency = concurrency
 
-# Manages HTTP sessions with retry logic for robustness.
+# Token-bucket limiter that paces requests to a steady rate across all threads.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate_limit must be a positive number of requests per second")
+        # Number of tokens added per second.
+        self.rate = rate
+        # Maximum number of tokens that can accumulate, i.e. the allowed burst size.
+        # At least one token must fit, otherwise rates below 1/s could never grant a request.
+        self.capacity = max(1.0, capacity if capacity is not None else rate)
+        self.tokens = float(self.capacity)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        # Consume a token if one is available; otherwise return how long to wait for the next one.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        # Block until a token is available, then consume it.
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)  # Sleep outside the lock so other threads can refill and check.
+
+    async def acquire_async(self):
+        # Same as acquire, but yields to the event loop while waiting.
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+# Manages the HTTP connection pool with retry logic for robustness.
 class SessionManager:
-    def __init__(self, user_agent):
-        # Setup a requests session with custom User-Agent.
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': user_agent})
+    def __init__(self, user_agent, max_threads=5):
         # Configure retries for transient errors.
         retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        # A bare urllib3 pool skips requests' per-call session overhead; size it so every worker thread can reuse a connection.
+        self.pool = urllib3.PoolManager(num_pools=1, maxsize=max_threads * 2, retries=retries, headers={'User-Agent': user_agent})
 
     def get(self, url):
-        # Perform a GET request, streaming response for efficiency with large files.
-        return self.session.get(url, stream=True)
+        # Perform a GET request; tiles are small, so read the body eagerly and release the connection.
+        return self.pool.request('GET', url, preload_content=True)
+
+# Every zstd frame starts with these bytes; used to tell compressed tiles from raw PNGs.
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Metadata written once tiles are stored zstd-compressed, so MBTiles readers don't serve them as PNGs.
+ZSTD_METADATA = [('format', 'png+zstd'), ('compression', 'zstd')]
 
 # Handles interactions with the MBTiles SQLite database.
 class MBTilesManager:
-    def __init__(self, db_path):
-        # Path to the SQLite database file.
+    # Hot-path statements, shared by the write and lookup methods below.
+    SAVE_IMAGE_SQL = "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)"
+    # An upsert (not INSERT OR REPLACE) so re-pointing a tile fires the map_update trigger that drops orphaned images.
+    SAVE_MAP_SQL = "INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?) ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_id = excluded.tile_id WHERE tile_id != excluded.tile_id"
+    TILE_EXISTS_SQL = "SELECT COUNT(*) FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+
+    def __init__(self, db_path, batch_size=256, compress=False, dict_samples=1024, dict_size=131072):
+        # Path to the SQLite database file; it must be a real file because a read-only connection is opened on it too.
+        if not db_path or db_path == ":memory:":
+            raise ValueError("mbtiles_file must be set to the path of the MBTiles file to write")
         self.db_path = db_path
-        # Thread-local storage for database connections.
-        self.local_conn = threading.local()
+        # Optional zstd compression of tile blobs using a dictionary trained on the first downloaded tiles.
+        self.compress = compress
+        self.dict_samples = dict_samples
+        self.dict_size = dict_size
+        self.zstd_dict = None
+        self._samples = []
+        new_db = not os.path.exists(db_path) or os.path.getsize(db_path) == 0
+        # Single connection shared by all writers; autocommit mode so transactions are opened explicitly.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        if new_db:
+            # Page size and auto-vacuum mode only take effect if set before the first table and before WAL is enabled.
+            self.conn.execute("PRAGMA page_size=16384;")  # Larger pages mean fewer overflow pages for tile blobs.
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")  # Lets close() reclaim free pages without a full VACUUM.
+        self.apply_pragmas(self.conn)
+        # Lets queries (and the tiles_decompressed view) read zstd-compressed blobs.
+        self.conn.create_function("zstd_decompress", 1, self.decompress_tile, deterministic=True)
+        self.conn.create_function("tile_hash", 1, self.tile_hash, deterministic=True)  # Used when migrating old databases.
+        self.cur = self.conn.cursor()  # Cursor reused by every write.
+        self.conn_lock = threading.RLock()  # Serializes use of the shared connection across threads.
+        # Maximum number of tiles committed per transaction by the downloader's writer thread.
+        self.batch_size = batch_size
         # Initialize the database schema.
         self.initialize_db()
+        # Separate read-only connection so existence checks don't wait on the writer (WAL allows both).
+        self.read_conn = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        self.apply_cache_pragmas(self.read_conn)
+        self.read_conn.create_function("zstd_decompress", 1, self.decompress_tile, deterministic=True)
+        self.read_lock = threading.Lock()
 
-    def get_conn(self):
-        # Get or create a database connection for the current thread.
-        if not hasattr(self.local_conn, "conn"):
-            self.local_conn.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        return self.local_conn.conn
+    def apply_pragmas(self, conn):
+        # Use WAL so readers don't block the writer and commits need a single fsync.
+        cur = conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL;")
+        cur.execute("PRAGMA synchronous=NORMAL;")
+        cur.execute("PRAGMA journal_size_limit=67108864;")  # Truncate the WAL back to 64 MB after checkpoints.
+        self.apply_cache_pragmas(conn)
 
-    def initialize_db(self):
-        # Create tiles and metadata tables if they don't already exist.
-        conn = self.get_conn()
+    def apply_cache_pragmas(self, conn):
+        # Per-connection cache settings; unlike the journal pragmas these also apply to read-only connections.
         cur = conn.cursor()
-        cur.execute('''CREATE TABLE IF NOT EXISTS tiles (
-                       zoom_level INTEGER,
-                       tile_column INTEGER,
-                       tile_row INTEGER,
-                       tile_data BLOB,
-                       PRIMARY KEY (zoom_level, tile_column, tile_row))''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS metadata (
-                       name TEXT,
-                       value TEXT,
-                       UNIQUE(name))''')
-        # Insert some default metadata values.
-        metadata = [
-            ('name', 'OpenStreetMapTiles'),
-            ('type', 'overlay'),
-            ('version', '1.1'),
-            ('description', 'OpenStreetMap tile downloader'),
-            ('format', 'png')
-        ]
-        for name, value in metadata:
-            cur.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", (name, value))
-        conn.commit()
+        cur.execute("PRAGMA temp_store=MEMORY;")
+        cur.execute("PRAGMA cache_size=-20000;")  # Roughly 20 MB of page cache.
+        cur.execute("PRAGMA mmap_size=268435456;")  # Map up to 256 MB of the database file.
+
+    def initialize_db(self):
+        # Create the metadata, images and map tables plus the tiles view if they don't already exist.
+        with self.conn_lock:
+            cur = self.cur
+            cur.execute("BEGIN")
+            cur.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                           name TEXT,
+                           value TEXT,
+                           UNIQUE(name))''')
+            # Reuse a dictionary trained during an earlier run so existing compressed tiles stay readable.
+            cur.execute("SELECT value FROM metadata WHERE name='zstd_dict'")
+            row = cur.fetchone()
+            if row:
+                self.zstd_dict = zstandard.ZstdCompressionDict(row[0])
+            # Insert some default metadata values.
+            metadata = [
+                ('name', 'OpenStreetMapTiles'),
+                ('type', 'overlay'),
+                ('version', '1.1'),
+                ('description', 'OpenStreetMap tile downloader'),
+                ('format', 'png')
+            ]
+            if self.zstd_dict is not None:
+                metadata += ZSTD_METADATA  # Overrides the png format for databases holding compressed tiles.
+            for name, value in metadata:
+                cur.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", (name, value))
+            # Deduplicated MBTiles layout: each distinct image is stored once and referenced from map.
+            cur.execute('''CREATE TABLE IF NOT EXISTS images (
+                           tile_id TEXT PRIMARY KEY,
+                           tile_data BLOB)''')
+            cur.execute('''CREATE TABLE IF NOT EXISTS map (
+                           zoom_level INTEGER,
+                           tile_column INTEGER,
+                           tile_row INTEGER,
+                           tile_id TEXT,
+                           PRIMARY KEY (zoom_level, tile_column, tile_row))''')
+            cur.execute("SELECT type FROM sqlite_master WHERE name='tiles'")
+            if cur.fetchone() == ('table',):
+                # Databases written by earlier versions keep blobs in a tiles table; move them into images/map.
+                cur.execute("DROP VIEW IF EXISTS tiles_decompressed")
+                cur.execute("ALTER TABLE tiles RENAME TO tiles_legacy")
+                cur.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) SELECT tile_hash(zstd_decompress(tile_data)), tile_data FROM tiles_legacy")
+                cur.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) SELECT zoom_level, tile_column, tile_row, tile_hash(zstd_decompress(tile_data)) FROM tiles_legacy")
+                cur.execute("DROP TABLE tiles_legacy")
+            # Delete an image once the last tile pointing at it is re-pointed; only runs when a stored tile changes.
+            cur.execute('''CREATE TRIGGER IF NOT EXISTS map_update AFTER UPDATE OF tile_id ON map
+                           WHEN NOT EXISTS (SELECT 1 FROM map WHERE tile_id = old.tile_id)
+                           BEGIN
+                               DELETE FROM images WHERE tile_id = old.tile_id;
+                           END''')
+            cur.execute('''CREATE VIEW IF NOT EXISTS tiles AS
+                           SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+                           FROM map JOIN images ON images.tile_id = map.tile_id''')
+            # View exposing plain PNG data; only readable on connections that register zstd_decompress.
+            cur.execute('''CREATE VIEW IF NOT EXISTS tiles_decompressed AS
+                           SELECT zoom_level, tile_column, tile_row, zstd_decompress(tile_data) AS tile_data FROM tiles''')
+            cur.execute("COMMIT")
+
+    def tile_hash(self, tile_data):
+        # Content id of the uncompressed tile bytes; identical tiles (e.g. empty ocean) share one image row.
+        return hashlib.sha256(tile_data).hexdigest()[:16]
+
+    def compress_tiles(self, tiles, cur):
+        # Compress tile data with the shared dictionary, training it once enough sample tiles are seen.
+        # Called from save_tiles with conn_lock held, so the sampling state needs no extra locking.
+        if self.zstd_dict is None and self._samples is not None:
+            self._samples.extend(tile_data for _, _, _, tile_data in tiles)
+            if len(self._samples) >= self.dict_samples:
+                try:
+                    self.zstd_dict = zstandard.train_dictionary(self.dict_size, self._samples)
+                    cur.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", ('zstd_dict', self.zstd_dict.as_bytes()))
+                    cur.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", ZSTD_METADATA)
+                except zstandard.ZstdError as e:
+                    logging.warning(f"Could not train zstd dictionary, storing tiles uncompressed: {e}")
+                self._samples = None  # Stop collecting samples either way.
+        if self.zstd_dict is None:
+            return tiles  # Tiles are kept raw until a dictionary exists.
+        cctx = zstandard.ZstdCompressor(dict_data=self.zstd_dict, level=6)
+        return [(zoom, x, y, cctx.compress(tile_data)) for zoom, x, y, tile_data in tiles]
+
+    def decompress_tile(self, tile_data):
+        # Return the original tile bytes, passing through blobs that were stored uncompressed.
+        if tile_data is None or bytes(tile_data[:4]) != ZSTD_MAGIC:
+            return tile_data
+        return zstandard.ZstdDecompressor(dict_data=self.zstd_dict).decompress(tile_data)
 
     def tile_exists(self, zoom, x, y):
         # Check if a tile already exists in the database to avoid re-downloading.
-        conn = self.get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, 2**zoom - 1 - y))
-        exists = cur.fetchone()[0] > 0
+        with self.read_lock:
+            cur = self.read_conn.execute(self.TILE_EXISTS_SQL, (zoom, x, 2**zoom - 1 - y))
+            exists = cur.fetchone()[0] > 0
         return exists
 
+    def existing_tiles(self, zoom_range):
+        # Load the (zoom, column, TMS row) keys of all stored tiles within the zoom range in one query.
+        with self.read_lock:
+            cur = self.read_conn.execute("SELECT zoom_level, tile_column, tile_row FROM map WHERE zoom_level BETWEEN ? AND ?", (zoom_range[0], zoom_range[1]))
+            return frozenset(cur.fetchall())
+
     def save_tile(self, zoom, x, y, tile_data):
-        # Insert or replace a tile in the database.
-        conn = self.get_conn()
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)", (zoom, x, 2**zoom - 1 - y, sqlite3.Binary(tile_data)))
-        conn.commit()
+        # Insert or replace a single tile; bulk writers should use save_tiles.
+        self.save_tiles([(zoom, x, y, tile_data)])
+
+    def save_tiles(self, tiles):
+        # Insert or replace a batch of (zoom, x, y, data) tiles in a single transaction.
+        with self.conn_lock:
+            cur = self.cur
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                tile_ids = [self.tile_hash(tile_data) for _, _, _, tile_data in tiles]  # Hash before compressing.
+                if self.compress:
+                    tiles = self.compress_tiles(tiles, cur)
+                cur.executemany(self.SAVE_IMAGE_SQL, [(tile_id, tile_data) for tile_id, (_, _, _, tile_data) in zip(tile_ids, tiles)])
+                cur.executemany(self.SAVE_MAP_SQL, [(zoom, x, 2**zoom - 1 - y, tile_id) for tile_id, (zoom, x, y, _) in zip(tile_ids, tiles)])
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
 
-    def close_conn(self):
-        # Close the database connection for the current thread.
-        if hasattr(self.local_conn, "conn"):
-            self.local_conn.conn.close()
-            del self.local_conn.conn
+    def vacuum(self):
+        # Return free pages (e.g. from images dropped by the map_update trigger) to the OS.
+        with self.conn_lock:
+            # Only shrinks the file for databases created with auto_vacuum=INCREMENTAL; a no-op otherwise.
+            # executescript steps the pragma to completion; a single execute() frees just one page.
+            self.conn.executescript("PRAGMA incremental_vacuum;")
+
+    def close(self):
+        # Fold the WAL back into the database file so the .mbtiles is complete on its own, then close both connections.
+        self.read_conn.close()
+        with self.conn_lock:
+            self.vacuum()
+            self.cur.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+            self.cur.close()  # An unfinished statement would keep the connection (and its WAL) open after close().
+        self.conn.close()
 
 # Orchestrates tile downloading, including concurrency and rate limiting.
 class TileDownloader:
@@ -121,47 +306,136 @@ class TileDownloader:
         self.config = config  # Configuration settings.
         self.session_manager = session_manager  # HTTP session manager.
         self.mbtiles_manager = mbtiles_manager  # SQLite database manager.
-        self.semaphore = threading.Semaphore(config.rate_limit * config.max_threads)  # Semaphore for rate limiting.
+        self.rate_limiter = TokenBucket(config.rate_limit)  # Token bucket enforcing rate_limit requests per second.
         self.pbar_lock = threading.Lock()  # Lock for synchronizing progress bar updates.
+        # The progress bar is only redrawn every pbar_step tiles to keep lock traffic off the hot path.
+        self.pbar_step = 100
+        self.progress_counter = itertools.count(1)  # next() is atomic, so threads can share it without a lock.
+        # Downloaded tiles are handed to a single writer thread so workers never contend for the SQLite write lock.
+        self.write_q = queue.Queue(maxsize=1024)
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def _writer_loop(self):
+        # Drain the write queue, committing up to mbtiles_manager.batch_size tiles per transaction.
+        while True:
+            batch = [self.write_q.get()]
+            while len(batch) < self.mbtiles_manager.batch_size:
+                try:
+                    batch.append(self.write_q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.mbtiles_manager.save_tiles(batch)
+            except Exception as e:
+                logging.error(f"Failed to save {len(batch)} tiles: {e}")
+            finally:
+                for _ in batch:
+                    self.write_q.task_done()
+
+    def advance_progress(self, pbar):
+        # Count one finished tile, updating the progress bar once per pbar_step tiles.
+        if next(self.progress_counter) % self.pbar_step == 0:
+            with self.pbar_lock:
+                pbar.update(self.pbar_step)
 
     def download_tile(self, zoom, x, y, pbar, pbar_lock):
         # Download a single tile and save it to the database.
-        thread_id = threading.get_ident()  # Get the current thread identifier for logging.
         tile_url = self.config.url_template.format(zoom=zoom, x=x, y=y)  # Construct the tile URL.
-        logging.info(f"Thread {thread_id}: Starting download {tile_url}")
+        self.rate_limiter.acquire()  # Wait for a token before hitting the tile server.
+        response = self.session_manager.get(tile_url)
+        if response.status == 200:
+            self.write_q.put((zoom, x, y, response.data))  # Hand the tile to the writer thread.
+            logging.debug("Downloaded %s", tile_url)  # Lazy formatting: no string is built unless DEBUG is on.
+        else:
+            logging.warning(f"Tile download failed {tile_url}, status code: {response.status}")
+
+    def download_tiles(self, tiles, pbar, existing=None):
+        # Download multiple tiles using a thread pool, keeping only a bounded number of futures in flight.
+        max_in_flight = self.config.max_threads * 4
+        tiles_iter = iter(tiles)
+        with ThreadPoolExecutor(max_workers=self.config.max_threads) as executor:
+            futures = set()
+            while True:
+                # Refill up to the limit so memory stays flat however many tiles the iterator yields.
+                for zoom, x, y in itertools.islice(tiles_iter, max_in_flight - len(futures)):
+                    futures.add(executor.submit(self.download_tile_rate_limited, zoom, x, y, pbar, self.pbar_lock, existing))
+                if not futures:
+                    break
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Exception occurred: {e}")  # Progress was already counted by the task.
+
+    def download_tile_rate_limited(self, zoom, x, y, pbar, pbar_lock, existing=None):
+        # Download a tile with rate limiting, checking the pre-scanned existing set when one is given.
+        # Rate limiting happens in download_tile so skipped tiles don't consume tokens.
+        try:
+            if existing is not None:
+                exists = (zoom, x, 2**zoom - 1 - y) in existing
+            else:
+                exists = self.mbtiles_manager.tile_exists(zoom, x, y)
+            if not exists:
+                self.download_tile(zoom, x, y, pbar, pbar_lock)
+            else:
+                skipped_tiles_logger.info(f"Skipped: Tile already exists: zoom {zoom}, x {x}, y {y}")  # Log skipped tiles.
+        finally:
+            self.advance_progress(pbar)  # Each tile is counted exactly once, whether downloaded, skipped or failed.
+
+    async def fetch_tile_async(self, http, tile_url, retries=5, backoff_factor=1):
+        # GET a tile, retrying connection errors, timeouts and transient server errors with exponential backoff like SessionManager does.
+        for attempt in range(retries + 1):
+            try:
+                async with http.get(tile_url) as response:
+                    if response.status not in (502, 503, 504) or attempt == retries:
+                        return response.status, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+    async def download_tile_async(self, http, zoom, x, y, pbar, existing=None):
+        # Download a single tile on the event loop and hand it to the writer thread.
+        loop = asyncio.get_running_loop()
+        tile_url = self.config.url_template.format(zoom=zoom, x=x, y=y)  # Construct the tile URL.
         try:
-            response = self.session_manager.get(tile_url)
-            if response.status_code == 200:
-                self.mbtiles_manager.save_tile(zoom, x, y, response.content)
-                logging.info(f"Thread {thread_id}: Downloaded {tile_url}")
+            if existing is not None:
+                exists = (zoom, x, 2**zoom - 1 - y) in existing
             else:
-                logging.warning(f"Thread {thread_id}: Tile download failed {tile_url}, status code: {response.status_code}")
+                exists = await loop.run_in_executor(None, self.mbtiles_manager.tile_exists, zoom, x, y)
+            if exists:
+                skipped_tiles_logger.info(f"Skipped: Tile already exists: zoom {zoom}, x {x}, y {y}")  # Log skipped tiles.
+                return
+            await self.rate_limiter.acquire_async()  # Wait for a token before hitting the tile server.
+            status, content = await self.fetch_tile_async(http, tile_url)
+            if status == 200:
+                # Queue.put may block when the writer falls behind, so keep it off the event loop.
+                await loop.run_in_executor(None, self.write_q.put, (zoom, x, y, content))
+                logging.debug("Downloaded %s", tile_url)
+            else:
+                logging.warning(f"Tile download failed {tile_url}, status code: {status}")
         finally:
-            with self.pbar_lock:  # Synchronize updates to the progress bar.
-                pbar.update(1)
-            self.mbtiles_manager.close_conn()  # Close the database connection for the current thread.
+            self.advance_progress(pbar)
 
-    def download_tiles(self, tiles, pbar):
-        # Download multiple tiles using a thread pool.
-        with ThreadPoolExecutor(max_workers=self.config.max_threads) as executor:
-            futures = [executor.submit(self.download_tile_rate_limited, zoom, x, y, pbar, self.pbar_lock) for zoom, x, y in tiles]
-            for future in as_completed(futures):
+    async def download_tiles_async(self, tiles, pbar, existing=None):
+        # Download multiple tiles with a fixed number of worker coroutines sharing one connection pool.
+        concurrency = self.config.concurrency
+        connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=30, sock_connect=10)  # Per-request limits so a stalled socket is retried.
+        headers = {'User-Agent': self.config.user_agent}
+        tiles_iter = iter(tiles)  # Shared by all workers; safe because they run on a single thread.
+
+        async def worker():
+            for zoom, x, y in tiles_iter:
                 try:
-                    future.result()
+                    await self.download_tile_async(http, zoom, x, y, pbar, existing)
                 except Exception as e:
                     logging.error(f"Exception occurred: {e}")
-                    with self.pbar_lock:  # Synchronize updates to the progress bar in case of an error.
-                        pbar.update(1)
 
-    def download_tile_rate_limited(self, zoom, x, y, pbar, pbar_lock):
-        # Download a tile with rate limiting.
-        with self.semaphore:  # Acquire a semaphore slot to enforce rate limiting.
-            if not self.mbtiles_manager.tile_exists(zoom, x, y):
-                self.download_tile(zoom, x, y, pbar, pbar_lock)
-            else:
-                skipped_tiles_logger.info(f"Skipped: Tile already exists: zoom {zoom}, x {x}, y {y}")  # Log skipped tiles.
-                with pbar_lock:
-                    pbar.update(1)  # Increment the progress bar for skipped tiles.
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as http:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
 
     def download_tiles_to_mbtiles(self, geojson_path=None):
         # Main method to download tiles and save them to an MBTiles file.
@@ -174,41 +448,71 @@ class TileDownloader:
 
         # Calculate the total number of tiles to be downloaded.
         total_tiles = sum([4 ** z for z in range(self.config.zoom_levels[0], self.config.zoom_levels[1] + 1)])
-        # Calculate non-priority tiles by excluding priority ones.
-        non_priority_tiles = [(zoom, x, y) for zoom in range(self.config.zoom_levels[0], self.config.zoom_levels[1] + 1) for x in range(2 ** zoom) for y in range(2 ** zoom) if (zoom, x, y) not in priority_tiles]
-        # Combine priority and non-priority tiles.
-        all_tiles = priority_tiles + non_priority_tiles
+        # Stream priority tiles first, then the rest, without materializing the full tile list.
+        all_tiles = self.iter_tiles(priority_tiles)
+
+        # Look up already stored tiles once instead of querying the database per tile.
+        existing = self.mbtiles_manager.existing_tiles(self.config.zoom_levels)
 
         pbar = tqdm(total=total_tiles, desc='Downloading tiles')  # Initialize the progress bar.
-        self.download_tiles(all_tiles, pbar)  # Download all tiles.
+        self.progress_counter = itertools.count(1)
+        if self.config.concurrency:
+            asyncio.run(self.download_tiles_async(all_tiles, pbar, existing))  # Download all tiles on an event loop.
+        else:
+            self.download_tiles(all_tiles, pbar, existing)  # Download all tiles with the thread pool.
+        self.write_q.join()  # Wait for the writer thread to commit every downloaded tile.
+        pbar.update((next(self.progress_counter) - 1) % self.pbar_step)  # Report tiles since the last batched update.
         pbar.close()  # Close the progress bar when done.
 
+    def iter_tiles(self, priority_tiles):
+        # Yield priority tiles first, then every other tile in the zoom range, skipping priority ones.
+        yield from priority_tiles
+        priority_set = set(priority_tiles)  # Set gives O(1) membership tests.
+        for zoom in range(self.config.zoom_levels[0], self.config.zoom_levels[1] + 1):
+            for x in range(2 ** zoom):
+                for y in range(2 ** zoom):
+                    if (zoom, x, y) not in priority_set:
+                        yield (zoom, x, y)
+
     def load_geojson(self, geojson_path):
         # Load a GeoJSON file from the specified path.
         with open(geojson_path, 'r') as f:
             return json.load(f)
 
-    def tile_bounds(self, x, y, z):
-        # Calculate the geographical bounds of a tile.
-        n = 2.0 ** z
-        lon_min = x / n * 360.0 - 180.0
-        lat_min_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
-        lat_min = math.degrees(lat_min_rad)
-        lon_max = (x + 1) / n * 360.0 - 180.0
-        lat_max_rad = math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n)))
-        lat_max = math.degrees(lat_max_rad)
-        return (lon_min, lat_min, lon_max, lat_max)
-
-    def tiles_in_priority_zones(self, zoom, geojson):
+    def tile_edges(self, zoom):
+        # Calculate the longitude and latitude of every tile edge at a zoom level.
+        n = 2 ** zoom
+        edges_lon = np.arange(n + 1) / n * 360.0 - 180.0
+        edges_lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.arange(n + 1) / n))))
+        return edges_lon, edges_lat
+
+    def tiles_in_priority_zones(self, zoom, geojson, max_boxes=65536):
         # Identify tiles within priority zones defined by a GeoJSON.
-        tiles = []
         geom = shape(geojson['features'][0]['geometry'])
-        for x in range(2 ** zoom):
-            for y in range(2 ** zoom):
-                bounds = self.tile_bounds(x, y, zoom)
-                tile_poly = box(bounds[0], bounds[1], bounds[2], bounds[3])
-                if tile_poly.intersects(geom):
-                    tiles.append((zoom, x, y))
+        n = 2 ** zoom
+        # Tile (x, y) spans edges_lon[x]..edges_lon[x + 1] and edges_lat[y + 1]..edges_lat[y].
+        edges_lon, edges_lat = self.tile_edges(zoom)
+        # Only tiles overlapping the geometry's bounding box can intersect it; find that index range.
+        min_lon, min_lat, max_lon, max_lat = geom.bounds
+        lats_ascending = edges_lat[::-1]
+        x_lo = max(0, int(np.searchsorted(edges_lon, min_lon, side='left')) - 1)
+        x_hi = min(n - 1, int(np.searchsorted(edges_lon, max_lon, side='right')) - 1)
+        y_lo = max(0, n - int(np.searchsorted(lats_ascending, max_lat, side='right')))
+        y_hi = min(n - 1, n - int(np.searchsorted(lats_ascending, min_lat, side='left')))
+        if x_lo > x_hi or y_lo > y_hi:
+            return []
+        tiles = []
+        ys = np.arange(y_lo, y_hi + 1)
+        # Build boxes for a few columns at a time so memory stays bounded for large polygons.
+        step = max(1, max_boxes // len(ys))
+        for x_start in range(x_lo, x_hi + 1, step):
+            # "ij" indexing keeps x as the outer axis, matching the tile ordering of the full grid.
+            xs, chunk_ys = np.meshgrid(np.arange(x_start, min(x_start + step, x_hi + 1)), ys, indexing='ij')
+            xs, chunk_ys = xs.ravel(), chunk_ys.ravel()
+            polys = shapely.box(edges_lon[xs], edges_lat[chunk_ys + 1], edges_lon[xs + 1], edges_lat[chunk_ys])
+            # Let GEOS find the intersecting tiles instead of testing each box from Python.
+            idx = np.sort(STRtree(polys).query(geom, predicate='intersects'))
+            tiles += [(zoom, int(x), int(y)) for x, y in zip(xs[idx], chunk_ys[idx])]
         return tiles
 
 # Entry point for the script.
@@ -220,11 +524,13 @@ if __name__ == "__main__":
         rate_limit=100,  # Number of requests per second.
         mbtiles_file=r"",  # Specify the path to the MBTiles file.
         user_agent='OpenStreetMapTileDownloader/1.0',  # User-Agent for HTTP requests.
-        max_threads=5  # Maximum number of concurrent download threads.
+        max_threads=5,  # Maximum number of concurrent download threads.
+        concurrency=64  # In-flight requests on the asyncio downloader; set to None to use the thread pool.
     )
 
-    session_manager = SessionManager(config.user_agent)  # Initialize the session manager with the user agent.
+    session_manager = SessionManager(config.user_agent, config.max_threads)  # Initialize the session manager with the user agent and pool size.
 
+    mbtiles_manager = None
     try:
         mbtiles_manager = MBTilesManager(config.mbtiles_file)  # Initialize the MBTiles manager with the database path.
         mbtiles_manager.initialize_db()  # Ensure that the database schema is set up.
@@ -233,3 +539,6 @@ if __name__ == "__main__":
         tile_downloader.download_tiles_to_mbtiles(geojson_path=r"")  # Start downloading tiles, specify the GeoJSON path if needed.
     except Exception as e:
         logging.error(f"An error occurred: {e}")  # Log any exceptions that occur during execution.
+    finally:
+        if mbtiles_manager is not None:
+            mbtiles_manager.close()  # Checkpoint the WAL so the MBTiles file is self-contained.